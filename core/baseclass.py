@@ -3,13 +3,17 @@ from core.decorators import retry
 from core.handlers import RoverHandler
 
 from abc import ABCMeta, abstractmethod
+from threading import Lock
 from configparser import ConfigParser
-from time import time
+from tempfile import mkstemp
+from time import time, monotonic
 from praw import handlers
 from pkg_resources import resource_filename
 from praw.errors import HTTPException
 
+import os
 import re
+import sqlite3
 import logging
 import praw
 
@@ -43,6 +47,9 @@ class PluginBase(metaclass=ABCMeta):
                             `oa_refresh(force=False)`
     :type OA_ACCESS_TOKEN: str
     :vartype OA_ACCESS_TOKEN: str
+    :ivar OA_ACCESS_SCOPE: *Scopes granted to OA_ACCESS_TOKEN, needed to restore a persisted access token.
+    :type OA_ACCESS_SCOPE: set
+    :vartype OA_ACCESS_SCOPE: set
     :ivar OA_REFRESH_TOKEN: *Refresh token which gets queried the first time a plugin is initialized, otherwise loaded.
     :type OA_REFRESH_TOKEN: str
     :vartype OA_REFRESH_TOKEN: str
@@ -55,10 +62,20 @@ class PluginBase(metaclass=ABCMeta):
     :ivar OA_TOKEN_DURATION: *OAuth Token validation timer. Usually set to 59minutes to have a good error margin
     :type OA_TOKEN_DURATION: int | float
     :vartype OA_TOKEN_DURATION: int | float
-    :ivar OA_VALID_UNTIL: *Determines how long the OA_ACCESS_TOKEN is valid as timestamp.
+    :ivar OA_VALID_UNTIL: *Determines how long the OA_ACCESS_TOKEN is valid as `time.monotonic()` timestamp.
                            Gets refreshed by `oa_refresh(force=False`
     :type OA_VALID_UNTIL: int | float
     :vartype OA_VALID_UNTIL: int | float
+    :ivar OA_REFRESH_AT: *Monotonic timestamp after which `oa_refresh(force=False)` fetches a new access token.
+    :type OA_REFRESH_AT: int | float
+    :vartype OA_REFRESH_AT: int | float
+    :ivar REFRESH_FRACTION: *Fraction of `OA_TOKEN_DURATION` after which the token gets refreshed proactively. Can be
+                             overwritten with `refresh_fraction` in the plugin config.
+    :type REFRESH_FRACTION: float
+    :vartype REFRESH_FRACTION: float
+    :ivar REFRESH_BUFFER: *Seconds before `OA_VALID_UNTIL` in which the access token is already considered expired.
+    :type REFRESH_BUFFER: int
+    :vartype REFRESH_BUFFER: int
     :ivar session: A session which is used to interface with Reddit.
     :type session: praw.Reddit
     :vartype session: praw.Reddit
@@ -75,35 +92,55 @@ class PluginBase(metaclass=ABCMeta):
     :type handler: core.handler.RedditRoverHandler
     :vartype handler: RedditRoverHandler
     """
+    REFRESH_BUFFER = 60     # Refresh a minute before the token would actually run out.
+    REFRESH_FRACTION = 0.8  # Refresh after 80% of the token lifetime.
+    MARK_READ_BATCH = 25    # Messages per mark-as-read request, keeps the request body small.
+    RE_BANMSG = re.compile(r'ban /([ru])/([\d\w_]*)', re.UNICODE)
+    _cached_config = None   # ConfigParser shared between all plugins, see factory_config
+    _cached_mtime = None
+    _config_lock = Lock()   # All plugins write the same file
 
     def __init__(self, database, handler, bot_name, setup_from_config=True):
         self.OA_TOKEN_DURATION = 3540   # Tokens are valid for 60min, this one is it for 59min.
+        self.OA_ACCESS_TOKEN = None
+        self.OA_ACCESS_SCOPE = None
+        self.OA_VALID_UNTIL = 0         # Forces a refresh on the first call
+        self.OA_REFRESH_AT = 0
         self.session = None             # Placeholder
-        self.logger = self.factory_logger()
+        self._authenticated = False     # True once a logged in session exists
+        self._refresh_lock = Lock()
+        self.logger = self.factory_logger(bot_name)
         self.database = database
         self.BOT_NAME = bot_name
-        self.RE_BANMSG = re.compile(r'ban /([r|u])/([\d\w_]*)', re.UNICODE)
         if not handler:
             self.handler = RoverHandler()
         else:
             self.handler = handler
         if setup_from_config:
             self.config = self.factory_config()
-            get = lambda x: self.config.get(bot_name, x)
+            section = self._load_config_section(bot_name)
+            get = lambda x: section[x]
+            get_b = lambda x: self.config.getboolean(bot_name, x)
             self.DESCRIPTION = get('description')
-            self.IS_LOGGED_IN = self.config.getboolean(bot_name, 'is_logged_in')
-            options = [option for option, value in self.config.items(bot_name)]
+            self.IS_LOGGED_IN = get_b('is_logged_in')
+            refresh_fraction = float(section.get('refresh_fraction', self.REFRESH_FRACTION))
+            if 0 < refresh_fraction <= 1:
+                self.REFRESH_FRACTION = refresh_fraction
+            else:
+                self.logger.warning('refresh_fraction of {} has to be in (0, 1], using {} instead.'.format(
+                    refresh_fraction, self.REFRESH_FRACTION))
             check_values = ('app_key', 'app_secret', 'self_ignore', 'username')
             if self.IS_LOGGED_IN:
-                if all(value in options for value in check_values):  # check if important keys are in
-                    self.SELF_IGNORE = self.config.getboolean(bot_name, 'self_ignore')
+                if all(value in section for value in check_values):  # check if important keys are in
+                    self.SELF_IGNORE = get_b('self_ignore')
                     self.USERNAME = get('username')
                     self.OA_APP_KEY = get('app_key')
                     self.OA_APP_SECRET = get('app_secret')
-                    if 'refresh_token' in options:
+                    if 'refresh_token' in section:
                         self.OA_REFRESH_TOKEN = get('refresh_token')
                     else:
                         self._get_keys_manually()
+                    self._load_access_token()
                     self.factory_reddit(True)
                 else:
                     raise AttributeError('Config is incomplete, check for your keys.')
@@ -133,14 +170,16 @@ class PluginBase(metaclass=ABCMeta):
         return True
 
     @staticmethod
-    def factory_logger():
+    def factory_logger(bot_name):
         """
-        Returns a Logger named 'plugin'.
+        Returns a Logger named 'plugin.<bot_name>', which logs through the handlers of the 'plugin' logger.
 
-        :return: Unchilded Logger 'Plugin'
+        :param bot_name: Name of the plugin, used as child name of the logger.
+        :type bot_name: str
+        :return: Child Logger of 'plugin'
         :rtype: logging.Logger
         """
-        return logging.getLogger("plugin")
+        return logging.getLogger("plugin.{}".format(bot_name))
 
     def factory_reddit(self, login=False):
         """
@@ -156,19 +195,46 @@ class PluginBase(metaclass=ABCMeta):
                 "Necessary attributes are not set for this function."
             self.session.set_oauth_app_info(self.OA_APP_KEY, self.OA_APP_SECRET,
                                             'http://127.0.0.1:65010/authorize_callback')
+            if self.OA_ACCESS_TOKEN and monotonic() < self.OA_REFRESH_AT:
+                try:
+                    self.session.set_access_credentials(self.OA_ACCESS_SCOPE, self.OA_ACCESS_TOKEN,
+                                                        self.OA_REFRESH_TOKEN)
+                    self._authenticated = True
+                    return
+                except (HTTPException, praw.errors.OAuthException) as e:
+                    self.logger.warning('Persisted access token was rejected ({}), refreshing it.'.format(
+                        e.__class__.__name__))
+                    self.OA_ACCESS_TOKEN = None
             self.oa_refresh(force=True)
+            self._authenticated = True
 
     @staticmethod
     def factory_config():
         """
         Sets up a standard config-parser to bot_config.ini. Does not have to be used, but it is handy.
+        The parsed config is shared between all plugins and only read again if the file has changed since.
 
         :returns: Set up ConfigParser object, reading `/config/bot_config.ini`.
         :rtype: ConfigParser
         """
-        config = ConfigParser()
-        config.read(resource_filename('config', 'bot_config.ini'))
-        return config
+        path = resource_filename('config', 'bot_config.ini')
+        mtime = os.stat(path).st_mtime
+        if PluginBase._cached_config is None or mtime != PluginBase._cached_mtime:
+            config = ConfigParser()
+            config.read(path)
+            PluginBase._cached_config, PluginBase._cached_mtime = config, mtime
+        return PluginBase._cached_config
+
+    def _load_config_section(self, bot_name):
+        """
+        Reads all options of the plugins config section at once.
+
+        :param bot_name: Name of the config section.
+        :type bot_name: str
+        :return: Dictionary of all options and their raw values.
+        :rtype: dict
+        """
+        return dict(self.config.items(bot_name))
 
     def _get_keys_manually(self):
         """
@@ -191,11 +257,38 @@ class PluginBase(metaclass=ABCMeta):
         code = return_url.split('code=')[-1]
         access_information = self.session.get_access_information(code)
         self.OA_REFRESH_TOKEN = access_information['refresh_token']
-        self.config.set(self.BOT_NAME, 'refresh_token', access_information['refresh_token'])
-        with open(resource_filename('config', 'bot_config.ini'), 'w') as f:
-            self.config.write(f)
-            f.close()
-        self.oa_refresh(force=True)
+        self._save_config({'refresh_token': access_information['refresh_token']})
+
+    def _save_config(self, options):
+        """
+        Sets options in the plugins config section of bot_config.ini. The file is read again first, so only these
+        options change and edits made meanwhile are kept. It is written into a temporary file and then moved over the
+        original, so a crash while writing can't leave a truncated config behind.
+
+        :param options: Options and their values to set in the section of this plugin.
+        :type options: dict
+        """
+        path = resource_filename('config', 'bot_config.ini')
+        with PluginBase._config_lock:
+            config = ConfigParser()
+            config.read(path)
+            if not config.has_section(self.BOT_NAME):
+                config.add_section(self.BOT_NAME)
+            for option, value in options.items():
+                config.set(self.BOT_NAME, option, value)
+            fd, tmp_path = mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    config.write(f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.chmod(tmp_path, os.stat(path).st_mode)  # mkstemp creates the file as 0600
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+            PluginBase._cached_config, PluginBase._cached_mtime = config, os.stat(path).st_mtime
+            self.config = config
 
     def add_comment(self, thing_id, text):
         """
@@ -209,7 +302,7 @@ class PluginBase(metaclass=ABCMeta):
         """
         assert self.session and self.session.has_oauth_app_info, "{} is not logged in," \
                                                                  "cannot comment on.".format(self.BOT_NAME)
-        self._oa_refresh()
+        self.oa_refresh()
         # noinspection PyProtectedMember
         return self.session._add_comment(thing_id, text)
 
@@ -223,25 +316,77 @@ class PluginBase(metaclass=ABCMeta):
         """
         assert self.OA_REFRESH_TOKEN and self.session, 'Cannot refresh, no refresh token or session is missing.'
         self.logger.debug('Dispatching OAuth refresh.')
-        if force or time() > self.OA_VALID_UNTIL:
+        if force or monotonic() > self.OA_REFRESH_AT:
             token_dict = self.session.refresh_access_information(self.OA_REFRESH_TOKEN)
             self.OA_ACCESS_TOKEN = token_dict['access_token']
-            self.OA_VALID_UNTIL = time() + self.OA_TOKEN_DURATION
+            self.OA_ACCESS_SCOPE = set(token_dict['scope'])
+            self._schedule_refresh(monotonic())
             self.session.set_access_credentials(**token_dict)
+            self._persist_access_token()
+
+    def _schedule_refresh(self, issued_at):
+        """
+        Sets the timestamps of the current access token, based on when it was issued.
+
+        :param issued_at: `time.monotonic()` timestamp when the access token was fetched.
+        :type issued_at: float
+        """
+        self.OA_VALID_UNTIL = issued_at + self.OA_TOKEN_DURATION
+        self.OA_REFRESH_AT = min(issued_at + self.OA_TOKEN_DURATION * self.REFRESH_FRACTION,
+                                 self.OA_VALID_UNTIL - self.REFRESH_BUFFER)
+
+    def _persist_access_token(self):
+        """
+        Stores the current access token in the database, so a restarted bot can reuse it instead of refreshing.
+        """
+        if not self.database:
+            return
+        valid_until = time() + self.OA_VALID_UNTIL - monotonic()  # persisted as wall clock time
+        try:
+            self.database.set_access_token(self.BOT_NAME, self.OA_ACCESS_TOKEN,
+                                           ' '.join(sorted(self.OA_ACCESS_SCOPE)), valid_until)
+        except sqlite3.Error as e:  # only a cache for the next start, the token in memory is fine
+            self.logger.warning('Could not persist access token of {}: {}'.format(self.BOT_NAME, e))
+
+    def _load_access_token(self):
+        """
+        Loads the access token of the last run from the database, if it is still valid for a while.
+        """
+        if not self.database:
+            return
+        try:
+            stored = self.database.get_access_token(self.BOT_NAME)
+        except sqlite3.Error as e:
+            self.logger.warning('Could not load access token of {}: {}'.format(self.BOT_NAME, e))
+            return
+        if not stored:
+            return
+        access_token, access_scope, valid_until = stored
+        remaining = valid_until - time()
+        if remaining > self.REFRESH_BUFFER:
+            self.OA_ACCESS_TOKEN = access_token
+            self.OA_ACCESS_SCOPE = set(access_scope.split())
+            self._schedule_refresh(monotonic() + remaining - self.OA_TOKEN_DURATION)
 
     def oa_refresh(self, force=False):
         """
-        Calls _oa_refresh and tries to reset OAuth credentials if it fails several times.
+        Calls _oa_refresh and tries to reset OAuth credentials if it fails several times. Only one thread refreshes at
+        a time, threads waiting for it return without refreshing again.
 
         :param force: Forces to refresh the access token
         :type force: bool
         """
-        try:
-            self._oa_refresh(force)
-        except (HTTPException, praw.errors.OAuthAppRequired):  # OAuthAppRequired: Possible bug, currently untracked
-            # Good news: This works. Bad news: I don't remember why the same keys suddenly work.
-            self.factory_reddit()
-            self._oa_refresh(True)
+        if not force and monotonic() < self.OA_REFRESH_AT:
+            return
+        with self._refresh_lock:
+            if not force and monotonic() < self.OA_REFRESH_AT:  # another thread refreshed while we waited
+                return
+            try:
+                self._oa_refresh(force)
+            except (HTTPException, praw.errors.OAuthAppRequired):  # OAuthAppRequired: Possible bug, currently untracked
+                # Good news: This works. Bad news: I don't remember why the same keys suddenly work.
+                self.factory_reddit()
+                self._oa_refresh(True)
 
     @retry(HTTPException)
     def get_unread_messages(self, mark_as_read=True):
@@ -253,17 +398,23 @@ class PluginBase(metaclass=ABCMeta):
         :param mark_as_read: Decides if the all messages get marked as read (speeds up the message reading every time)
         :type mark_as_read: bool
         """
-        if hasattr(self, "session"):
+        if self._authenticated:
             self.oa_refresh()
             try:
-                msgs = self.session.get_unread()
-                for msg in msgs:
+                handled = []
+                try:
+                    for msg in self.session.get_unread():
+                        handled.append(msg)
+                        self.on_new_message(msg)
+                        if not msg.was_comment and not msg.author.name.lower() == 'automoderator':
+                            self.database.add_message(msg.id, self.BOT_NAME, msg.created_utc,
+                                                      msg.subject, msg.author.name, msg.body)
+                finally:
+                    # only messages that were handled (or failed while handling) get marked, in a few requests
                     if mark_as_read:
-                        msg.mark_as_read()
-                    self.on_new_message(msg)
-                    if not msg.was_comment and not msg.author.name.lower() == 'automoderator':
-                        self.database.add_message(msg.id, self.BOT_NAME, msg.created_utc,
-                                                  msg.subject, msg.author.name, msg.body)
+                        for i in range(0, len(handled), self.MARK_READ_BATCH):
+                            # noinspection PyProtectedMember
+                            self.session._mark_as_read([msg.fullname for msg in handled[i:i + self.MARK_READ_BATCH]])
             except AssertionError:
                 pass
 
@@ -286,7 +437,7 @@ class PluginBase(metaclass=ABCMeta):
         if not message.was_comment and author in message.body.lower():
             regex_result = self.RE_BANMSG.search(message.body)
             if regex_result:
-                sub, result = self.RE_BANMSG.search(message.body).groups()
+                sub, result = regex_result.groups()
             else:
                 return
             # check if a user wants to ban a user or a sub wants to ban a sub.
@@ -362,7 +513,7 @@ class PluginBase(metaclass=ABCMeta):
         if not self.database:
             self.logger.error('{} does not have a valid database pointer.'.format(self.BOT_NAME))
         else:
-            if isinstance(obj, praw.objects.Submission) or isinstance(obj, praw.objects.Comment):
+            if isinstance(obj, (praw.objects.Submission, praw.objects.Comment)):
                 self.database.insert_into_update(response_object.fullname, self.BOT_NAME, lifetime, interval)
             else:
                 self.logger.error('response_object has an invalid object type.')
@@ -16,6 +16,7 @@ class Database:
        - **modules**:         persistent module storage
        - **userbans**:        a table to ban users from being able to trigger certain plugins
        - **subbans**:         a table to ban subreddits from being able to trigger certain plugins
+       - **oauth_tokens**:    the last OAuth access token per plugin, to reuse it after a restart
 
     :ivar logger: A database specific database logger. Is currently missing debug-messages for database actions.
     :type logger: logging.Logger
@@ -119,6 +120,14 @@ class Database:
                 ''')
             info('meta_stats')
 
+        if not self._database_check_if_exists('oauth_tokens'):
+            self.cur.execute(
+                '''CREATE TABLE IF NOT EXISTS oauth_tokens
+                      (module_name STR(50) PRIMARY KEY NOT NULL,
+                       access_token STR, access_scope STR, valid_until REAL)
+                ''')
+            info('oauth_tokens')
+
     def _database_check_if_exists(self, table_name):
         """
         Helper method to check if a certain table (by name) exists. Refrain from using it if you're not adding new
@@ -692,6 +701,34 @@ class Database:
                                      (?),
                                      (?)) ''', (msg_id, bot_module, created, username, title, body))
 
+    def set_access_token(self, module, access_token, access_scope, valid_until):
+        """
+        Stores the current OAuth access token of a plugin, replacing the previous one.
+
+        :param module: A string naming your plugin.
+        :type module: str
+        :param access_token: OAuth access token.
+        :type access_token: str
+        :param access_scope: Space separated scopes of that token.
+        :type access_scope: str
+        :param valid_until: Unix timestamp until the token is valid.
+        :type valid_until: float
+        """
+        self.cur.execute("""INSERT OR REPLACE INTO oauth_tokens (module_name, access_token, access_scope, valid_until)
+                            VALUES ((?), (?), (?), (?))""", (module, access_token, access_scope, valid_until))
+
+    def get_access_token(self, module):
+        """
+        Returns the last stored OAuth access token of a plugin.
+
+        :param module: A string naming your plugin.
+        :type module: str
+        :return: Tuple of ``(access_token, access_scope, valid_until)`` or None
+        """
+        self.cur.execute('SELECT access_token, access_scope, valid_until FROM oauth_tokens WHERE module_name = (?)',
+                         (module,))
+        return self.cur.fetchone()
+
     def get_all_messages(self):
         """
         Returns all messages in the messages table.